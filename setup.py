@@ -8,11 +8,19 @@ import re
 from glob import glob
 from os.path import basename
 from os.path import dirname
+from os.path import exists
 from os.path import join
 from os.path import splitext
 
+from setuptools import Extension
 from setuptools import find_packages
 from setuptools import setup
+from setuptools.command.build_ext import build_ext
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
 
 
 def read(*names, **kwargs):
@@ -23,6 +31,38 @@ def read(*names, **kwargs):
         return fh.read()
 
 
+class optional_build_ext(build_ext):
+    """
+    Builds the compiled extensions if possible.  They only speed up routines that
+    have pure python fallbacks, so the install proceeds if they fail to build.
+    """
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except Exception as e:
+            self._warn(e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as e:
+            self._warn(e)
+
+    def _warn(self, e):
+        print('WARNING: Failed to build the optional compiled extensions (%s).  Falling back to pure python.' % e)
+
+
+if cythonize is not None:
+    ext_modules = cythonize([Extension('pydiffmap._sym', ['src/pydiffmap/_sym.pyx'])],
+                            language_level=3)
+elif exists(join('src', 'pydiffmap', '_sym.c')):
+    # Source distributions ship the C file generated by Cython, so they build without it.
+    ext_modules = [Extension('pydiffmap._sym', ['src/pydiffmap/_sym.c'])]
+else:
+    ext_modules = []
+
+
 setup(
     name='pydiffmap',
     version='0.2.0.1',
@@ -39,7 +79,10 @@ setup(
     package_dir={'': 'src'},
     py_modules=[splitext(basename(path))[0] for path in glob('src/*.py')],
     include_package_data=True,
+    exclude_package_data={'pydiffmap': ['*.c']},
     zip_safe=False,
+    ext_modules=ext_modules,
+    cmdclass={'build_ext': optional_build_ext},
     classifiers=[
         # complete classifier list: http://pypi.python.org/pypi?%3Aaction=list_classifiers
         'Development Status :: 3 - Alpha',
@@ -0,0 +1,81 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""
+Compiled routines for symmetrizing sparse kernel matrices.
+"""
+from libc.stdint cimport int32_t, int64_t
+
+ctypedef fused index_t:
+    int32_t
+    int64_t
+
+
+cdef inline double _combine(double a, double b, int mode) nogil:
+    if mode == 0:
+        return 0.5 * (a + b)
+    elif mode == 1:
+        return a if a > b else b
+    else:
+        return a if a < b else b
+
+
+def symmetrize_csr(const double[::1] data, const index_t[::1] indices, const index_t[::1] indptr,
+                   const double[::1] data_T, const index_t[::1] indices_T, const index_t[::1] indptr_T,
+                   int mode, double[::1] out_data, index_t[::1] out_indices, index_t[::1] out_indptr):
+    """
+    Combines the elements of a csr matrix A and its transpose, in a single
+    pass over both.  Column indices within each row must be sorted.
+
+    Parameters
+    ----------
+    data, indices, indptr : memoryviews
+        csr arrays of the matrix A.
+    data_T, indices_T, indptr_T : memoryviews
+        csr arrays of the transpose of A.
+    mode : int
+        How to combine elements: 0 for their average, 1 for their maximum, and
+        2 for their minimum.  Elements missing from one matrix are taken to be
+        zero.
+    out_data, out_indices, out_indptr : memoryviews
+        Preallocated csr arrays for the result.  out_data and out_indices must
+        be able to hold len(data) + len(data_T) elements.
+
+    Returns
+    -------
+    nnz : int
+        Number of elements written to out_data and out_indices.  Elements
+        equal to zero are not stored.
+    """
+    cdef Py_ssize_t n_rows = indptr.shape[0] - 1
+    cdef Py_ssize_t row, p, p_end, q, q_end
+    cdef Py_ssize_t nnz = 0
+    cdef index_t col
+    cdef double val
+
+    with nogil:
+        out_indptr[0] = 0
+        for row in range(n_rows):
+            p = indptr[row]
+            p_end = indptr[row + 1]
+            q = indptr_T[row]
+            q_end = indptr_T[row + 1]
+            # Walk the sorted column indices of both rows in lock-step.
+            while (p < p_end) or (q < q_end):
+                if (q >= q_end) or ((p < p_end) and (indices[p] < indices_T[q])):
+                    col = indices[p]
+                    val = _combine(data[p], 0., mode)
+                    p += 1
+                elif (p >= p_end) or (indices_T[q] < indices[p]):
+                    col = indices_T[q]
+                    val = _combine(0., data_T[q], mode)
+                    q += 1
+                else:
+                    col = indices[p]
+                    val = _combine(data[p], data_T[q], mode)
+                    p += 1
+                    q += 1
+                if val != 0.:
+                    out_indices[nnz] = col
+                    out_data[nnz] = val
+                    nnz += 1
+            out_indptr[row + 1] = nnz
+    return nnz
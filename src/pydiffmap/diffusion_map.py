@@ -5,11 +5,29 @@ Routines and Class definitions for the diffusion maps algorithm.
 from __future__ import absolute_import
 
 import numpy as np
+import scipy.linalg as spl
 import scipy.sparse as sps
 import scipy.sparse.linalg as spsl
 import warnings
 from . import kernel
 from . import utils
+try:
+    from threadpoolctl import ThreadpoolController
+except ImportError:
+    ThreadpoolController = None
+try:
+    import scikits.umfpack as umfpack
+except ImportError:
+    umfpack = None
+
+# Largest matrix size for which the eigenvectors are computed with a dense solver.
+_DENSE_EIGSOLVE_MAX_N = 250
+# Matrix size below which the eigensolve is restricted to a single BLAS thread.
+_SERIAL_EIGSOLVE_MAX_N = 2000
+# Lazily created controller for the BLAS thread pools; building one scans the loaded libraries.
+_threadpool_controller = None
+# Shift used in shift-invert mode, relative to the largest diagonal element of the generator.
+_SHIFT_INVERT_REL_SIGMA = 1e-6
 
 
 class DiffusionMap(object):
@@ -34,6 +52,8 @@ class DiffusionMap(object):
         If true, normalize the final constructed transition matrix by the bandwidth as described in Berry and Harlim. [1]_
     oos : 'nystroem' or 'power', optional
         Method to use for out-of-sample extension.
+    shift_invert : boolean, optional
+        If true, the eigenvectors of large systems are computed using ARPACK in shift-invert mode, which requires a sparse LU factorization of the generator.  This can converge considerably faster when the desired eigenvalues are closely spaced relative to the spectrum, but the factorization is expensive for kernels with many neighbors in more than two dimensions.
 
     References
     ----------
@@ -43,7 +63,7 @@ class DiffusionMap(object):
 
     def __init__(self, kernel_object, alpha=0.5, n_evecs=1,
                  weight_fxn=None, density_fxn=None,
-                 bandwidth_normalize=False, oos='nystroem'):
+                 bandwidth_normalize=False, oos='nystroem', shift_invert=False):
         """
         Initializes Diffusion Map, sets parameters.
         """
@@ -55,11 +75,12 @@ class DiffusionMap(object):
         self.oos = oos
         self.density_fxn = density_fxn
         self.local_kernel = kernel_object
+        self.shift_invert = shift_invert
 
     @classmethod
     def from_sklearn(cls, alpha=0.5, k=64, kernel_type='gaussian', epsilon='bgh', n_evecs=1, neighbor_params=None,
                      metric='euclidean', metric_params=None, weight_fxn=None, density_fxn=None, bandwidth_type=None,
-                     bandwidth_normalize=False, oos='nystroem'):
+                     bandwidth_normalize=False, oos='nystroem', shift_invert=False, neighbor_backend='sklearn'):
         """
         Builds the diffusion map using a kernel constructed using the Scikit-learn nearest neighbor object.
         Parameters are largely the same as the constructor, but in place of the kernel object it take
@@ -81,6 +102,8 @@ class DiffusionMap(object):
             Optional parameters required for the metric given.
         bandwidth_type: callable, number, string, or None, optional
             Type of bandwidth to use in the kernel.  If None (default), a fixed bandwidth kernel is used.  If a callable function, the data is passed to the function, and the bandwidth is output (note that the function must take in an entire dataset, not the points 1-by-1).  If a number, e.g. -.25, a kernel density estimate is performed, and the bandwidth is taken to be q**(input_number).  For a string input, the input is assumed to be an evaluatable expression in terms of the dimension d, e.g. "-1/(d+2)".  The dimension is then estimated, and the bandwidth is set to q**(evaluated input string).
+        neighbor_backend : string, optional
+            Library used for the nearest neighbor search, either 'sklearn' (default) or 'pynndescent'.  See the Kernel class for details.
 
         Examples
         --------
@@ -96,14 +119,16 @@ class DiffusionMap(object):
            (2016).
         """
 
-        buendia = kernel.Kernel(kernel_type=kernel_type, k=k, epsilon=epsilon, neighbor_params=neighbor_params, metric=metric, metric_params=metric_params, bandwidth_type=bandwidth_type)
-        dmap = cls(buendia, alpha=alpha, n_evecs=n_evecs, weight_fxn=weight_fxn, density_fxn=density_fxn, bandwidth_normalize=bandwidth_normalize, oos=oos)
+        buendia = kernel.Kernel(kernel_type=kernel_type, k=k, epsilon=epsilon, neighbor_params=neighbor_params, metric=metric, metric_params=metric_params, bandwidth_type=bandwidth_type,
+                                neighbor_backend=neighbor_backend)
+        dmap = cls(buendia, alpha=alpha, n_evecs=n_evecs, weight_fxn=weight_fxn, density_fxn=density_fxn, bandwidth_normalize=bandwidth_normalize, oos=oos,
+                   shift_invert=shift_invert)
         # if ((bandwidth_type is None) and (bandwidth_normalize is True)):
         #     warnings.warn('Bandwith normalization set to true, but no bandwidth function provided.  Setting to False.')
         return dmap
 
-    def _build_kernel(self, X, my_kernel):
-        my_kernel.fit(X)
+    def _build_kernel(self, X, my_kernel, neighbors=None):
+        my_kernel.fit(X, neighbors=neighbors)
         kernel_matrix = utils._symmetrize_matrix(my_kernel.compute())
         return kernel_matrix, my_kernel
 
@@ -151,6 +176,26 @@ class DiffusionMap(object):
 
         return L
 
+    def _build_symmetric_generator(self, kernel_matrix, right_norm_vec, weights, epsilon_fitted, bandwidths=None, bandwidth_normalize=False):
+        # The generator L = B (D^-1 K R - I) / epsilon, with R the right normalization,
+        # D the row sums of K R and B the optional bandwidth normalization, is similar to
+        # the symmetric matrix S = (s K s - B) / epsilon, with s = (B R D^-1)^1/2, via
+        # L = A^-1 S A, where A = (R D B^-1)^1/2.  Returns S and the diagonal of A, or
+        # Nones if the normalizations are not all positive.
+        r = right_norm_vec
+        if weights is not None:
+            r = r * weights
+        row_sum = np.asarray(kernel_matrix.dot(r)).ravel()
+        if (bandwidth_normalize and (bandwidths is not None)):
+            b = np.power(bandwidths, -2.)
+        else:
+            b = np.ones(kernel_matrix.shape[0])
+        if not (np.all(r > 0) and np.all(row_sum > 0) and np.all(b > 0)):
+            return None, None
+        scale = np.sqrt(b * r / row_sum)
+        conj_vec = np.sqrt(r * row_sum / b)
+        return _SymmetricGenerator(kernel_matrix, scale, b, epsilon_fitted), conj_vec
+
     def _make_diffusion_coords(self, L):
         evals, evecs = spsl.eigs(L, k=(self.n_evecs+1), which='LR')
         ix = evals.argsort()[::-1][1:]
@@ -159,20 +204,31 @@ class DiffusionMap(object):
         dmap = np.dot(evecs, np.diag(np.sqrt(-1. / evals)))
         return dmap, evecs, evals
 
-    def construct_Lmat(self, X):
+    def _make_symmetric_diffusion_coords(self, S, conj_vec):
+        evals, sym_evecs = _top_eigs(S, self.n_evecs+1, shift_invert=self.shift_invert)
+        evals = evals[1:]
+        # Transform back to eigenvectors of L, normalized as in _make_diffusion_coords.
+        evecs = sym_evecs[:, 1:] / conj_vec.reshape(-1, 1)
+        evecs /= np.linalg.norm(evecs, axis=0)
+        dmap = np.dot(evecs, np.diag(np.sqrt(-1. / evals)))
+        return dmap, evecs, evals
+
+    def construct_Lmat(self, X, precomputed_neighbors=None):
         """
-        Builds the transition matrix, but does NOT compute the eigenvectors.  This is useful for applications where the transition matrix itself is the object of interest.
+        Builds the transition matrix, but does NOT compute the eigenvectors.  This is useful for applications where the transition matrix itself is the object of interest.  The matrix is assembled from the normalized kernel when the attribute L is first accessed.
 
         Parameters
         ----------
         X : array-like, shape (n_query, n_features)
             Data upon which to construct the diffusion map.
+        precomputed_neighbors : scikit-learn NearestNeighbors object, optional
+            Nearest neighbor object already fit to X, to be used by the kernel in place of constructing a new one.  Its number of neighbors and metric must match those of the kernel.
 
         Returns
         -------
         self : the object itself
         """
-        kernel_matrix, my_kernel = self._build_kernel(X, self.local_kernel)
+        kernel_matrix, my_kernel = self._build_kernel(X, self.local_kernel, neighbors=precomputed_neighbors)
         weights = self._compute_weights(X)
 
         if self.density_fxn is not None:
@@ -185,9 +241,8 @@ class DiffusionMap(object):
             bandwidths = None
 
         q, right_norm_vec = self._make_right_norm_vec(kernel_matrix, q=density, bandwidths=bandwidths)
-        P = self._right_normalize(kernel_matrix, right_norm_vec, weights)
-        P = self._left_normalize(P)
-        L = self._build_generator(P, my_kernel.epsilon_fitted, bandwidths, bandwidth_normalize=self.bandwidth_normalize)
+        if self.bandwidth_normalize and (bandwidths is None):
+            warnings.warn('Bandwith normalization set to true, but no bandwidth function was found in normalization.  Not performing normalization')
 
         # Save data
         self.local_kernel = my_kernel
@@ -195,12 +250,33 @@ class DiffusionMap(object):
         self.data = X
         self.weights = weights
         self.kernel_matrix = kernel_matrix
-        self.L = L
+        # L is built from the saved data when first accessed.
+        self._L = None
         self.q = q
         self.right_norm_vec = right_norm_vec
         return self
 
-    def fit(self, X):
+    @property
+    def L(self):
+        """
+        Generator matrix of the diffusion process.  Fitting only needs its symmetrized form, so the matrix is built when first accessed.
+        """
+        if self._L is None:
+            try:
+                bandwidths = self.local_kernel.bandwidths
+            except AttributeError:
+                bandwidths = None
+            P = self._right_normalize(self.kernel_matrix, self.right_norm_vec, self.weights)
+            P = self._left_normalize(P)
+            self._L = self._build_generator(P, self.epsilon_fitted, bandwidths,
+                                            bandwidth_normalize=(self.bandwidth_normalize and (bandwidths is not None)))
+        return self._L
+
+    @L.setter
+    def L(self, L):
+        self._L = L
+
+    def fit(self, X, precomputed_neighbors=None):
         """
         Fits the data.
 
@@ -208,13 +284,24 @@ class DiffusionMap(object):
         ----------
         X : array-like, shape (n_query, n_features)
             Data upon which to construct the diffusion map.
+        precomputed_neighbors : scikit-learn NearestNeighbors object, optional
+            Nearest neighbor object already fit to X, to be used by the kernel in place of constructing a new one.  Its number of neighbors and metric must match those of the kernel.
 
         Returns
         -------
         self : the object itself
         """
-        self.construct_Lmat(X)
-        dmap, evecs, evals = self._make_diffusion_coords(self.L)
+        self.construct_Lmat(X, precomputed_neighbors=precomputed_neighbors)
+        try:
+            bandwidths = self.local_kernel.bandwidths
+        except AttributeError:
+            bandwidths = None
+        S, conj_vec = self._build_symmetric_generator(self.kernel_matrix, self.right_norm_vec, self.weights,
+                                                      self.epsilon_fitted, bandwidths, bandwidth_normalize=self.bandwidth_normalize)
+        if S is not None:
+            dmap, evecs, evals = self._make_symmetric_diffusion_coords(S, conj_vec)
+        else:
+            dmap, evecs, evals = self._make_diffusion_coords(self.L)
 
         # Save constructed data.
         self.evals = evals
@@ -250,7 +337,7 @@ class DiffusionMap(object):
             else:
                 raise ValueError('Did not understand the OOS algorithm specified')
 
-    def fit_transform(self, X):
+    def fit_transform(self, X, precomputed_neighbors=None):
         """
         Fits the data and returns diffusion coordinates.  equivalent to calling dmap.fit(X).transform(x).
 
@@ -258,13 +345,15 @@ class DiffusionMap(object):
         ----------
         X : array-like, shape (n_query, n_features)
             Data upon which to construct the diffusion map.
+        precomputed_neighbors : scikit-learn NearestNeighbors object, optional
+            Nearest neighbor object already fit to X, to be used by the kernel in place of constructing a new one.  Its number of neighbors and metric must match those of the kernel.
 
         Returns
         -------
         phi : numpy array, shape (n_query, n_eigenvectors)
             Transformed value of the given values.
         """
-        self.fit(X)
+        self.fit(X, precomputed_neighbors=precomputed_neighbors)
         return self.dmap
 
 
@@ -281,17 +370,132 @@ class TMDmap(DiffusionMap):
     def __init__(self, alpha=0.5, k=64, kernel_type='gaussian', epsilon='bgh',
                  n_evecs=1, neighbor_params=None, metric='euclidean',
                  metric_params=None, change_of_measure=None, density_fxn=None,
-                 bandwidth_type=None, bandwidth_normalize=False, oos='nystroem'):
+                 bandwidth_type=None, bandwidth_normalize=False, oos='nystroem', shift_invert=False,
+                 neighbor_backend='sklearn'):
 
         def weight_fxn(y_i):
             return np.sqrt(change_of_measure(y_i))
 
-        buendia = kernel.Kernel(kernel_type=kernel_type, k=k, epsilon=epsilon, neighbor_params=neighbor_params, metric=metric, metric_params=metric_params, bandwidth_type=bandwidth_type)
+        buendia = kernel.Kernel(kernel_type=kernel_type, k=k, epsilon=epsilon, neighbor_params=neighbor_params, metric=metric, metric_params=metric_params, bandwidth_type=bandwidth_type,
+                                neighbor_backend=neighbor_backend)
+
+        super(TMDmap, self).__init__(buendia, alpha=alpha, n_evecs=n_evecs, weight_fxn=weight_fxn, density_fxn=density_fxn, bandwidth_normalize=bandwidth_normalize, oos=oos,
+                                     shift_invert=shift_invert)
+
+
+class _SymmetricGenerator(spsl.LinearOperator):
+    """
+    Linear operator applying the symmetric matrix (s K s - B) / epsilon, where
+    s and B are diagonal, without forming the matrix explicitly.
+    """
+
+    def __init__(self, kernel_matrix, scale, diag, epsilon):
+        super(_SymmetricGenerator, self).__init__(dtype=np.float64, shape=kernel_matrix.shape)
+        self.kernel_matrix = kernel_matrix
+        self.scale = scale
+        self.diag = diag
+        self.epsilon = epsilon
+
+    def _matvec(self, x):
+        x = np.ravel(x)
+        return (self.scale * self.kernel_matrix.dot(self.scale * x) - self.diag * x) / self.epsilon
+
+    def _matmat(self, X):
+        scale = self.scale.reshape(-1, 1)
+        diag = self.diag.reshape(-1, 1)
+        return (scale * self.kernel_matrix.dot(scale * X) - diag * X) / self.epsilon
+
+    def toarray(self):
+        """
+        Returns the operator as a dense array.
+        """
+        scale = self.scale.reshape(-1, 1)
+        S = scale * self.kernel_matrix.toarray() * scale.T
+        S[np.diag_indices_from(S)] -= self.diag
+        return S / self.epsilon
+
+    def tosparse(self, shift=0.):
+        """
+        Returns the operator, minus shift times the identity, as a sparse csc matrix.
+        """
+        n = self.shape[0]
+        scale_diag = sps.spdiags(self.scale, 0, n, n)
+        S = scale_diag * self.kernel_matrix * scale_diag - sps.spdiags(self.diag + shift * self.epsilon, 0, n, n)
+        return sps.csc_matrix(S / self.epsilon)
 
-        super(TMDmap, self).__init__(buendia, alpha=alpha, n_evecs=n_evecs, weight_fxn=weight_fxn, density_fxn=density_fxn, bandwidth_normalize=bandwidth_normalize, oos=oos)
+
+def _top_eigs(A, k, shift_invert=False):
+    """
+    Computes the k algebraically largest eigenpairs of a symmetric operator,
+    sorted in descending order.  Small problems are solved with a dense
+    solver, which is faster than ARPACK at these sizes.
+
+    Parameters
+    ----------
+    A : _SymmetricGenerator
+        Symmetric operator whose eigenpairs are to be computed.
+    k : int
+        Number of eigenpairs to compute.
+    shift_invert : boolean, optional
+        If true, problems too large for the dense solver are solved with ARPACK in shift-invert mode.
+
+    Returns
+    -------
+    evals : numpy array, shape (k)
+        Eigenvalues of A in descending order.
+    evecs : numpy array, shape (n, k)
+        Corresponding eigenvectors of A.
+    """
+    n = A.shape[0]
+    if (ThreadpoolController is not None) and (n < _SERIAL_EIGSOLVE_MAX_N):
+        # At these sizes, threading overhead in BLAS outweighs any speedup.
+        with _get_threadpool_controller().limit(limits=1, user_api='blas'):
+            evals, evecs = _solve_eigs(A, k, shift_invert)
+    else:
+        evals, evecs = _solve_eigs(A, k, shift_invert)
+    ix = evals.argsort()[::-1][:k]
+    return evals[ix], evecs[:, ix]
+
+
+def _get_threadpool_controller():
+    global _threadpool_controller
+    if _threadpool_controller is None:
+        _threadpool_controller = ThreadpoolController()
+    return _threadpool_controller
+
+
+def _solve_eigs(A, k, shift_invert=False):
+    if A.shape[0] <= _DENSE_EIGSOLVE_MAX_N:
+        # Only compute the top k eigenpairs; the evr driver supports index subsets.
+        n = A.shape[0]
+        return spl.eigh(A.toarray(), driver='evr', subset_by_index=(n - k, n - 1))
+    elif shift_invert:
+        # The generator is negative semidefinite, and we want the eigenvalues closest to zero.
+        # These are the largest in magnitude after inverting around a small positive shift.
+        sigma = _SHIFT_INVERT_REL_SIGMA * np.max(np.abs(A.diag)) / A.epsilon
+        solve = _factorized(A.tosparse(shift=sigma))
+        OPinv = spsl.LinearOperator(A.shape, matvec=solve, dtype=np.float64)
+        return spsl.eigsh(A, k=k, sigma=sigma, which='LM', OPinv=OPinv)
+    else:
+        return spsl.eigsh(A, k=k, which='LA')
+
+
+def _factorized(A):
+    """
+    Factorizes a sparse csc matrix, returning a function that solves A x = b.  Uses UMFPACK
+    with iterative refinement disabled if scikit-umfpack is installed, and SuperLU otherwise.
+    """
+    if umfpack is not None:
+        family = 'dl' if A.indices.dtype == np.int64 else 'di'
+        umf = umfpack.UmfpackContext(family)
+        umf.control[umfpack.UMFPACK_IRSTEP] = 0
+        umf.numeric(A)
+        return lambda b: umf.solve(umfpack.UMFPACK_A, A, np.ravel(b))
+    else:
+        return spsl.splu(A, permc_spec='MMD_AT_PLUS_A').solve
 
 
-def nystroem_oos(dmap_object, Y):
+def nystroem_oos(dmap_object, Y, block_size=512):
     """
     Performs Nystroem out-of-sample extension to calculate the values of the diffusion coordinates at each given point.
 
@@ -301,18 +505,23 @@ def nystroem_oos(dmap_object, Y):
         Diffusion map upon which to perform the out-of-sample extension.
     Y : array-like, shape (n_query, n_features)
         Data for which to perform the out-of-sample extension.
+    block_size : int, optional
+        Number of query points for which the kernel is constructed at once.
 
     Returns
     -------
     phi : numpy array, shape (n_query, n_eigenvectors)
         Transformed value of the given values.
     """
-    # check if Y is equal to data. If yes, no computation needed.
-    # compute the values of the kernel matrix
-    kernel_extended = dmap_object.local_kernel.compute(Y)
     weights = dmap_object._compute_weights(dmap_object.local_kernel.data)
-    P = dmap_object._left_normalize(dmap_object._right_normalize(kernel_extended, dmap_object.right_norm_vec, weights))
-    oos_evecs = P * dmap_object.dmap
+    n_query = Y.shape[0]
+    oos_evecs = np.empty((n_query, dmap_object.dmap.shape[1]))
+    # Rows of the extended transition matrix are independent, so build it one block of points at a time.
+    for start in range(0, n_query, block_size):
+        stop = min(start + block_size, n_query)
+        kernel_extended = dmap_object.local_kernel.compute(Y[start:stop])
+        P = dmap_object._left_normalize(dmap_object._right_normalize(kernel_extended, dmap_object.right_norm_vec, weights))
+        oos_evecs[start:stop] = P * dmap_object.dmap
     # evals_p = dmap_object.local_kernel.epsilon_fitted * dmap_object.evals + 1.
     # oos_dmap = np.dot(oos_evecs, np.diag(1. / evals_p))
     return oos_evecs
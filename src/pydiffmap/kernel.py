@@ -15,6 +15,10 @@ try:
 except ModuleNotFoundError:
     from scipy.misc import logsumexp
 
+# Alternative names of metrics, as accepted by scikit-learn.
+_METRIC_ALIASES = {'l2': 'euclidean', 'l1': 'manhattan', 'cityblock': 'manhattan', 'infinity': 'chebyshev'}
+_MINKOWSKI_ALIASES = {1: 'manhattan', 2: 'euclidean', np.inf: 'chebyshev'}
+
 
 class Kernel(object):
     """
@@ -36,9 +40,12 @@ class Kernel(object):
         Optional parameters required for the metric given.
     bandwidth_type: callable, number, string, or None, optional
         Type of bandwidth to use in the kernel.  If None (default), a fixed bandwidth kernel is used.  If a callable function, the data is passed to the function, and the bandwidth is output (note that the function must take in an entire dataset, not the points 1-by-1).  If a number, e.g. -.25, a kernel density estimate is performed, and the bandwidth is taken to be q**(input_number).  For a string input, the input is assumed to be an evaluatable expression in terms of the dimension d, e.g. "-1/(d+2)".  The dimension is then estimated, and the bandwidth is set to q**(evaluated input string).
+    neighbor_backend : string, optional
+        Library used for the nearest neighbor search.  Options are 'sklearn' (default), which performs an exact search using scikit-learn, and 'pynndescent', which builds an approximate nearest neighbor graph using the pynndescent package.  The approximate search is considerably faster for large datasets.  If 'pynndescent' is used, neighbor_params are passed to pynndescent.NNDescent.
     """
 
-    def __init__(self, kernel_type='gaussian', epsilon='bgh', k=64, neighbor_params=None, metric='euclidean', metric_params=None, bandwidth_type=None):
+    def __init__(self, kernel_type='gaussian', epsilon='bgh', k=64, neighbor_params=None, metric='euclidean', metric_params=None, bandwidth_type=None,
+                 neighbor_backend='sklearn'):
         self.kernel_fxn = _parse_kernel_type(kernel_type)
         self.epsilon = epsilon
         self.k = k
@@ -48,6 +55,7 @@ class Kernel(object):
             neighbor_params = {}
         self.neighbor_params = neighbor_params
         self.bandwidth_type = bandwidth_type
+        self.neighbor_backend = neighbor_backend
         self.d = None
         self.epsilon_fitted = None
 
@@ -95,13 +103,25 @@ class Kernel(object):
         self.kde = my_nnkde
         return bandwidth_fxn, my_nnkde.d
 
+    def _check_neighbor_metric(self, neighbors):
+        metric_params = dict(self.metric_params or {})
+        if (self.metric == 'minkowski') and (self.neighbor_backend == 'sklearn') and ('p' in self.neighbor_params):
+            metric_params.setdefault('p', self.neighbor_params['p'])
+        kernel_metric = _canonical_metric(self.metric, metric_params)
+        # Fitted scikit-learn objects record the metric actually used, e.g. 'euclidean' for 'minkowski' with p=2.
+        neighbor_metric = _canonical_metric(getattr(neighbors, 'effective_metric_', neighbors.metric),
+                                            getattr(neighbors, 'effective_metric_params_', neighbors.metric_params))
+        if not _same_metric(kernel_metric, neighbor_metric):
+            raise ValueError("Precomputed nearest neighbors use the metric %s with parameters %s, but the kernel requires %s with parameters %s"
+                             % (neighbor_metric + kernel_metric))
+
     def _compute_bandwidths(self, X):
         if self.bandwidth_fxn is not None:
             return self.bandwidth_fxn(X)
         else:
             return None
 
-    def fit(self, X):
+    def fit(self, X, neighbors=None):
         """
         Fits the kernel to the data X, constructing the nearest neighbor tree.
 
@@ -109,6 +129,8 @@ class Kernel(object):
         ----------
         X : array-like, shape (n_query, n_features)
             Data upon which to fit the nearest neighbor tree.
+        neighbors : scikit-learn NearestNeighbors object, optional
+            Nearest neighbor object already fit to X, used in place of constructing a new one.  This allows the neighbor search structure to be shared between kernels on the same data.  The number of neighbors, the metric and the metric parameters must match the kernel.
 
         Returns
         -------
@@ -117,13 +139,29 @@ class Kernel(object):
         k0 = min(self.k, np.shape(X)[0])
         self.data = X
         # Construct Nearest Neighbor Tree
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", message="Parameter p is found in metric_params. The corresponding parameter from __init__ is ignored.")
-            self.neigh = NearestNeighbors(n_neighbors=k0,
-                                          metric=self.metric,
-                                          metric_params=self.metric_params,
-                                          **self.neighbor_params)
-        self.neigh.fit(X)
+        if neighbors is not None:
+            if neighbors.n_neighbors != k0:
+                raise ValueError("Precomputed nearest neighbors have n_neighbors=%d, but the kernel requires %d" % (neighbors.n_neighbors, k0))
+            if neighbors.n_samples_fit_ != np.shape(X)[0]:
+                raise ValueError("Precomputed nearest neighbors were not fit to data of the same size as X")
+            self._check_neighbor_metric(neighbors)
+            self.neigh = neighbors
+        elif self.neighbor_backend == 'sklearn':
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", message="Parameter p is found in metric_params. The corresponding parameter from __init__ is ignored.")
+                self.neigh = NearestNeighbors(n_neighbors=k0,
+                                              metric=self.metric,
+                                              metric_params=self.metric_params,
+                                              **self.neighbor_params)
+            self.neigh.fit(X)
+        elif self.neighbor_backend == 'pynndescent':
+            self.neigh = NNDescentNeighbors(n_neighbors=k0,
+                                            metric=self.metric,
+                                            metric_params=self.metric_params,
+                                            **self.neighbor_params)
+            self.neigh.fit(X)
+        else:
+            raise ValueError("Nearest neighbor backend was given as %s, but this was not recognized" % self.neighbor_backend)
         self.bandwidth_fxn = self.build_bandwidth_fxn(self.bandwidth_type)
         self.bandwidths = self._compute_bandwidths(X)
         self.scaled_dists = self._get_scaled_distance_mat(self.data, self.bandwidths)
@@ -291,6 +329,97 @@ class NNKDE(object):
         return density
 
 
+class NNDescentNeighbors(object):
+    """
+    Approximate nearest neighbor search built on pynndescent, exposing the
+    parts of the scikit-learn NearestNeighbors interface used by the kernels.
+
+    Parameters
+    ----------
+    n_neighbors : int, optional
+        Number of nearest neighbors in the neighbor graph.
+    metric : string or callable, optional
+        Distance metric to use.  See pynndescent.NNDescent for details.
+    metric_params : dict or None, optional
+        Optional parameters required for the metric given.
+    **nndescent_params
+        Additional parameters passed to pynndescent.NNDescent.  By default, n_jobs is set to -1.
+    """
+
+    def __init__(self, n_neighbors=5, metric='euclidean', metric_params=None, **nndescent_params):
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.metric_params = metric_params
+        self.nndescent_params = dict({'n_jobs': -1}, **nndescent_params)
+
+    def fit(self, X):
+        """
+        Builds the approximate nearest neighbor graph of the data X.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_query, n_features)
+            Data upon which to build the neighbor graph.
+
+        Returns
+        -------
+        self : the object itself
+        """
+        try:
+            from pynndescent import NNDescent
+        except ImportError:
+            raise ImportError("The 'pynndescent' neighbor backend requires the pynndescent package to be installed.")
+        self._fit_X = X
+        self.n_samples_fit_ = np.shape(X)[0]
+        self.index = NNDescent(X, n_neighbors=self.n_neighbors, metric=self.metric,
+                               metric_kwds=self.metric_params, **self.nndescent_params)
+        return self
+
+    def kneighbors_graph(self, X=None, n_neighbors=None, mode='connectivity'):
+        """
+        Computes the graph of the approximate k nearest neighbors of each point in X.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_query, n_features), optional
+            Query points.  If not provided, the neighbors of each point in the fitted data are returned, not counting the point itself.
+        n_neighbors : int, optional
+            Number of neighbors for each query point.  Defaults to the value passed to the constructor.
+        mode : 'connectivity' or 'distance', optional
+            Type of values stored in the returned matrix.
+
+        Returns
+        -------
+        A : scipy sparse csr matrix, shape (n_query, n_samples_fit)
+            Matrix whose nonzero elements in row i correspond to the neighbors of point i.
+        """
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        if X is None:
+            indices, distances = self.index.neighbor_graph
+            n = indices.shape[0]
+            is_self = (indices == np.arange(n).reshape(-1, 1))
+            is_self[~is_self.any(axis=1), -1] = True
+            indices = indices[~is_self].reshape(n, -1)[:, :n_neighbors]
+            distances = distances[~is_self].reshape(n, -1)[:, :n_neighbors]
+        elif X is self._fit_X:
+            indices, distances = self.index.neighbor_graph
+            indices = indices[:, :n_neighbors]
+            distances = distances[:, :n_neighbors]
+        else:
+            indices, distances = self.index.query(X, k=n_neighbors)
+
+        n_query, n_nbrs = indices.shape
+        if mode == 'distance':
+            data = distances.ravel().astype(np.float64)
+        elif mode == 'connectivity':
+            data = np.ones(n_query * n_nbrs)
+        else:
+            raise ValueError("Unsupported mode, must be one of 'connectivity' or 'distance' but got %s instead" % mode)
+        indptr = np.arange(0, n_query * n_nbrs + 1, n_nbrs)
+        return sps.csr_matrix((data, indices.ravel(), indptr), shape=(n_query, self.n_samples_fit_))
+
+
 def choose_optimal_epsilon_BGH(scaled_distsq, epsilons=None):
     """
     Calculates the optimal epsilon for kernel density estimation according to
@@ -394,6 +523,33 @@ def _scale_by_bw(d_yx, bw_x, bw_y):
     return d_yx
 
 
+def _canonical_metric(metric, metric_params):
+    """
+    Reduces a metric and its parameters to a canonical form, so that
+    equivalent choices such as 'minkowski' with p=2 and 'euclidean' agree.
+    """
+    params = {key: val for key, val in (metric_params or {}).items() if val is not None}
+    if metric == 'minkowski':
+        p = params.pop('p', 2)
+        if p in _MINKOWSKI_ALIASES:
+            metric = _MINKOWSKI_ALIASES[p]
+        else:
+            params['p'] = p
+    if not callable(metric):
+        metric = _METRIC_ALIASES.get(metric, metric)
+    return metric, params
+
+
+def _same_metric(metric_a, metric_b):
+    """
+    Checks if two canonical metrics, as returned by _canonical_metric, are the same.
+    """
+    (name_a, params_a), (name_b, params_b) = metric_a, metric_b
+    if (name_a != name_b) or (set(params_a) != set(params_b)):
+        return False
+    return all(np.array_equal(params_a[key], params_b[key]) for key in params_a)
+
+
 def _check_equal(X, Y):
     """
     Check if two datasets are equal.
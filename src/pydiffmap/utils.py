@@ -2,8 +2,17 @@
 """
 Utilities for constructing diffusion maps.
 """
+import sys
 import numpy as np
 import scipy.sparse as sps
+try:
+    from ._sym import symmetrize_csr as _symmetrize_csr
+except ImportError:
+    _symmetrize_csr = None
+
+# Approximate memory budget, in bytes, for the coordinates gathered in each
+# block of pairs evaluated by sparse_from_fxn.
+_PAIR_BLOCK_BYTES = 2**22
 
 
 def lookup_fxn(x, vals):
@@ -22,53 +31,205 @@ def lookup_fxn(x, vals):
     -------
     lf : function
         A function that, when input a value in x, outputs the corresponding
-        value in vals.
+        value in vals.  The attribute lf.batch evaluates the lookup on an
+        array of values at once.
     """
+    x_arr = np.asarray(x)
+    if (x_arr.ndim == 1) and np.issubdtype(x_arr.dtype, np.number):
+        if not hasattr(vals, '__len__'):
+            # Store one-shot iterables, so that they can be used by either lookup.
+            vals = list(vals)
+        vals_arr = _numeric_array(vals)
+        if (vals_arr is not None) and (vals_arr.ndim > 0) and (len(vals_arr) == len(x_arr)):
+            return _sorted_lookup_fxn(x_arr, vals_arr)
+
     # Build dictionary
-    lookup = {}
-    for i in range(len(x)):
-        lookup[str(x[i])] = vals[i]
+    if isinstance(x, np.ndarray):
+        # Key on the rows as lists, avoiding the boxing of each row as an array.
+        lookup = dict(zip(map(str, x.tolist()), vals))
+        key = _array_key
+    else:
+        lookup = {str(a): b for a, b in zip(x, vals)}
+        key = str
 
     # Define and return lookup function
     def lf(xi):
-        return lookup[str(xi)]
+        return lookup[key(xi)]
+
+    def lf_batch(xi_arr):
+        return np.array([lookup[key(xi)] for xi in xi_arr])
+
+    lf.batch = lf_batch
+    return lf
+
+
+def _array_key(xi):
+    return str(np.asarray(xi).tolist())
+
+
+def _numeric_array(vals):
+    """
+    Converts vals to a numeric array, returning None if they are ragged or
+    not numbers.
+    """
+    try:
+        vals_arr = np.asarray(vals)
+    except ValueError:
+        return None
+    if not np.issubdtype(vals_arr.dtype, np.number):
+        return None
+    return vals_arr
+
+
+def _sorted_lookup_fxn(x, vals):
+    """
+    Lookup function for one-dimensional numeric inputs and numeric array
+    values, which finds values
+    by binary search in the sorted inputs rather than by hashing.  As with a
+    dictionary, the last value given for a repeated input is returned.
+    """
+    order = np.argsort(x, kind='mergesort')
+    x_sorted = x[order]
+    table = vals[order]
+
+    def _find(xi):
+        # The stable sort keeps repeated inputs in their original order, so
+        # the rightmost match is the last one given.
+        ndx = np.searchsorted(x_sorted, xi, side='right') - 1
+        ndx_clipped = np.maximum(ndx, 0)
+        if not np.all(x_sorted[ndx_clipped] == xi):
+            raise KeyError(xi)
+        return ndx_clipped
+
+    def lf(xi):
+        return table[_find(xi)]
+
+    def lf_batch(xi_arr):
+        return table[_find(np.asarray(xi_arr))]
 
+    lf.batch = lf_batch
     return lf
 
 
-def sparse_from_fxn(X, K, function, Y=None):
+def sparse_from_fxn(X, K, function, Y=None, function_of_distance=None):
     """
     For a function f, constructs a sparse matrix where each element is
     f(Y_i, X_j) with the same sparsity structure as the matrix K.
 
     Parameters
     ----------
-    neighbors : scikit-learn NearestNeighbors object
-        Data structure containing the nearest neighbor information.
-        X values are drawn from the data in this object.
+    X : array-like, shape (n_samples, n_features)
+        Values corresponding to each column of the matrix.
+    K : scipy sparse matrix
+        Matrix whose sparsity structure is to be copied, e.g. a nearest
+        neighbor graph.
     function : function
         Function to apply to the pair Y_i, X_j.  Must take only two arguments
-        and return a number.
+        and return a number.  If the function also accepts two 2D arrays of
+        paired rows and returns a 1D array with one value per row, it is
+        evaluated on all pairs at once.  If the function is compiled with
+        numba.njit, the pairs are evaluated in a parallel compiled loop.
     Y : iterable or None
-        Values corresponding to each column of the matrix.  If None, defaults
-        to the data in the neighbors object.
+        Values corresponding to each row of the matrix.  If None, defaults
+        to X.
+    function_of_distance : callable or None, optional
+        If provided, K is taken to hold the distances between Y_i and X_j,
+        e.g. a nearest neighbor graph constructed with mode='distance', and
+        this function is applied to the array of stored distances in place
+        of evaluating function on each pair.  function is then ignored and
+        may be None.
 
     Returns
     -------
     M : scipy sparse csr matrix
-        Matrix with elements f(Y_i, X_j) for nearest neighbors, and zero
+        Matrix with elements f(Y_i, X_j) for nonzero elements of K, and zero
         otherwise.  Here Y_i is the i'th datapoint in Y, and X_j is the
-        j'th datapoint in the NearestNeighbors object.
+        j'th datapoint in X.
     """
+    if function_of_distance is not None:
+        M = sps.csr_matrix(K, copy=True)
+        M.data = np.asarray(function_of_distance(M.data), dtype=np.float64)
+        return M
+
     if Y is None:
         Y = X
-    row, col = _get_sparse_row_col(K)
+    # Reuse the csr structure of K rather than round-tripping through coo.
+    K = sps.csr_matrix(K)
+    row = np.repeat(np.arange(K.shape[0]), np.diff(K.indptr))
+    col = K.indices
+
+    fxn_vals = np.empty(len(row), dtype=np.float64)
+    if _is_numba_function(function):
+        _get_numba_fill_vals()(np.asarray(Y), np.asarray(X), row, col, function, fxn_vals)
+    elif _is_vectorized(function, Y, X, row, col):
+        # Evaluate in blocks of pairs so that the gathered coordinates stay small.
+        block_size = _pairs_per_block(X)
+        for start in range(0, len(row), block_size):
+            stop = min(start + block_size, len(row))
+            fxn_vals[start:stop] = function(Y[row[start:stop]], X[col[start:stop]])
+    else:
+        for n, (i, j) in enumerate(zip(row, col)):
+            fxn_vals[n] = function(Y[i], X[j])
+    return sps.csr_matrix((fxn_vals, K.indices.copy(), K.indptr.copy()), shape=K.shape)
+
+
+def _is_vectorized(function, Y, X, row, col):
+    """
+    Checks whether a pairwise function can be evaluated on blocks of paired
+    rows, by comparing a call on the first two pairs against calls on the
+    individual pairs.
+    """
+    if len(row) < 2:
+        return False
+    try:
+        block_vals = np.asarray(function(Y[row[:2]], X[col[:2]]))
+        if block_vals.shape != (2,):
+            return False
+        pair_vals = [function(Y[i], X[j]) for i, j in zip(row[:2], col[:2])]
+        return np.allclose(block_vals, pair_vals)
+    except Exception:
+        return False
+
+
+def _is_numba_function(function):
+    """
+    Checks whether a function has been compiled with numba.njit.  Numba is
+    only consulted if it has already been imported.
+    """
+    if 'numba' not in sys.modules:
+        return False
+    from numba.core.registry import CPUDispatcher
+    return isinstance(function, CPUDispatcher)
+
+
+_numba_fill_vals = None
+
+
+def _get_numba_fill_vals():
+    """
+    Builds, on first use, the compiled loop evaluating a numba function on
+    each pair of points.
+    """
+    global _numba_fill_vals
+    if _numba_fill_vals is None:
+        import numba
+
+        @numba.njit(parallel=True)
+        def fill_vals(Y, X, row, col, function, out):
+            for e in numba.prange(len(row)):
+                out[e] = function(Y[row[e]], X[col[e]])
 
-    fxn_vals = []
-    for i, j in zip(row, col):
-        fxn_vals.append(function(Y[i], X[j]))
-    fxn_vals = np.array(fxn_vals)
-    return sps.csr_matrix((fxn_vals, (row, col)), shape=K.shape)
+        _numba_fill_vals = fill_vals
+    return _numba_fill_vals
+
+
+def _pairs_per_block(X):
+    """
+    Number of pairs to evaluate at once, chosen so that the gathered rows of
+    X and Y fit in roughly _PAIR_BLOCK_BYTES of memory.
+    """
+    n_features = int(np.prod(np.shape(X)[1:]))
+    return max(1, _PAIR_BLOCK_BYTES // (2 * 8 * max(n_features, 1)))
 
 
 def _get_sparse_row_col(sparse_mat):
@@ -93,19 +254,42 @@ def _symmetrize_matrix(K, mode='or'):
         Symmetrized kernel matrix.
     """
 
+    K = sps.csr_matrix(K)
+    Ktrans = K.transpose().tocsr()
+    if mode not in _SYMMETRIZATION_MODES:
+        raise ValueError('Did not understand symmetrization method')
+    if _symmetrize_csr is not None:
+        return _symmetrize_compiled(K, Ktrans, _SYMMETRIZATION_MODES[mode])
     if mode == 'average':
-        return 0.5*(K + K.transpose())
+        return 0.5*(K + Ktrans)
     elif mode == 'or':
-        Ktrans = K.transpose()
-        dK = abs(K - Ktrans)
-        K = K + Ktrans
-        K = K + dK
-        return 0.5*K
+        # Equivalent to 0.5*(K + K^T + |K - K^T|), without the intermediate matrices.
+        return K.maximum(Ktrans)
     elif mode == 'and':
-        Ktrans = K.transpose()
-        dK = abs(K - Ktrans)
-        K = K + Ktrans
-        K = K - dK
-        return 0.5*K
-    else:
-        raise ValueError('Did not understand symmetrization method')
+        # Equivalent to 0.5*(K + K^T - |K - K^T|), without the intermediate matrices.
+        return K.minimum(Ktrans)
+
+
+_SYMMETRIZATION_MODES = {'average': 0, 'or': 1, 'and': 2}
+
+
+def _symmetrize_compiled(K, Ktrans, mode_code):
+    """
+    Symmetrizes a csr matrix using the compiled lock-step merge of the rows of
+    K and its transpose.
+    """
+    if not K.has_sorted_indices:
+        K = K.sorted_indices()
+    if not Ktrans.has_sorted_indices:
+        Ktrans.sort_indices()
+    index_dtype = np.promote_types(K.indices.dtype, Ktrans.indices.dtype)
+    indices, indptr = K.indices.astype(index_dtype, copy=False), K.indptr.astype(index_dtype, copy=False)
+    indices_T, indptr_T = Ktrans.indices.astype(index_dtype, copy=False), Ktrans.indptr.astype(index_dtype, copy=False)
+    max_nnz = K.nnz + Ktrans.nnz
+    out_data = np.empty(max_nnz, dtype=np.float64)
+    out_indices = np.empty(max_nnz, dtype=index_dtype)
+    out_indptr = np.empty(K.shape[0] + 1, dtype=index_dtype)
+    nnz = _symmetrize_csr(K.data.astype(np.float64, copy=False), indices, indptr,
+                          Ktrans.data.astype(np.float64, copy=False), indices_T, indptr_T,
+                          mode_code, out_data, out_indices, out_indptr)
+    return sps.csr_matrix((out_data[:nnz], out_indices[:nnz], out_indptr), shape=K.shape)
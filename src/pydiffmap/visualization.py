@@ -4,11 +4,14 @@ Some convenient visalisation routines.
 """
 from __future__ import absolute_import
 
+import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D  # noqa F401
 
+_HEXBIN_KWARGS = frozenset(['cmap', 'rasterized', 'linewidths'])
 
-def embedding_plot(dmap_instance, dim=2, scatter_kwargs=None, show=True):
+
+def embedding_plot(dmap_instance, dim=2, scatter_kwargs=None, show=True, hexbin_threshold=50000):
     """
     Creates diffusion map embedding scatterplot. By default, the first two diffusion
     coordinates are plotted against each other.
@@ -24,6 +27,13 @@ def embedding_plot(dmap_instance, dim=2, scatter_kwargs=None, show=True):
         point size, colormap, etc.
     show : boolean, optional
         If true, calls plt.show()
+    hexbin_threshold : int or None, optional
+        For two dimensional plots of more points than this, a hexagonal
+        binning of the points is drawn instead of a scatterplot.  The binning
+        only honours the colormap, rasterization and line width, so if
+        scatter_kwargs sets any other option (e.g. point color, size or
+        marker) a scatterplot is drawn regardless.
+        If None, a scatterplot is always drawn.
 
     Returns
     -------
@@ -39,15 +49,26 @@ def embedding_plot(dmap_instance, dim=2, scatter_kwargs=None, show=True):
     """
     if scatter_kwargs is None:
         scatter_kwargs = {}
+    # The hexagonal binning cannot reproduce per-point styling, so it is only used if the options all apply to it.
+    hexbin_compatible = set(scatter_kwargs).issubset(_HEXBIN_KWARGS)
+    # Rasterize the points, as drawing each one as a vector primitive is slow for large datasets.
+    scatter_kwargs = dict({'rasterized': True, 'linewidths': 0}, **scatter_kwargs)
+    # Single precision is ample for plotting, and halves the data passed to matplotlib.
+    coords = np.ascontiguousarray(dmap_instance.dmap[:, :dim].T, dtype=np.float32)
+    n_points = coords.shape[1]
     fig = plt.figure(figsize=(6, 6))
     if (dim == 2):
-        plt.scatter(dmap_instance.dmap[:, 0], dmap_instance.dmap[:, 1], **scatter_kwargs)
+        use_hexbin = (hexbin_threshold is not None) and (n_points > hexbin_threshold)
+        if use_hexbin and hexbin_compatible:
+            plt.hexbin(coords[0], coords[1], gridsize=200, mincnt=1, **scatter_kwargs)
+        else:
+            plt.scatter(coords[0], coords[1], **scatter_kwargs)
         plt.title('Embedding given by first two DCs.')
         plt.xlabel(r'$\psi_1$')
         plt.ylabel(r'$\psi_2$')
     elif (dim == 3):
         ax = fig.add_subplot(111, projection='3d')
-        ax.scatter(dmap_instance.dmap[:, 0], dmap_instance.dmap[:, 1], dmap_instance.dmap[:, 2], **scatter_kwargs)
+        ax.scatter(coords[0], coords[1], coords[2], **scatter_kwargs)
         ax.set_title('Embedding given by first three DCs.')
         ax.set_xlabel(r'$\psi_1$')
         ax.set_ylabel(r'$\psi_2$')
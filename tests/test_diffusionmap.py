@@ -1,12 +1,66 @@
 import numpy as np
 import pytest
+from collections import namedtuple
 
 from pydiffmap import diffusion_map as dm
+from sklearn.neighbors import NearestNeighbors
+
+WeightingData = namedtuple('WeightingData', ['data_x', 'data_y', 'real_evecs_x', 'real_evecs_y'])
+
+
+def _abs_correlations(real_evecs, evecs):
+    """
+    Absolute values of the correlation coefficients between each reference
+    eigenvector, given as a list of 1D arrays, and the corresponding column of
+    evecs.
+    """
+    R = np.column_stack(real_evecs)
+    E = evecs[:, :R.shape[1]]
+    Rc = R - R.mean(axis=0)
+    Ec = E - E.mean(axis=0)
+    corrs = (Rc * Ec).sum(axis=0) / (np.linalg.norm(Rc, axis=0) * np.linalg.norm(Ec, axis=0))
+    return np.abs(corrs)
+
+
+def _hermite_polynomials(Y):
+    # First four probabalists Hermite polynomials, in Horner form.
+    Y2 = Y*Y
+    return [Y, Y2-1., Y*(Y2-3.), Y2*(Y2-6.)+3.]
+
+
+@pytest.fixture(scope='module')
+def strip_1d_neighbors():
+    """
+    Nearest neighbor objects for the uniform and nonuniform 1D strips, shared
+    between the tests on each strip so that the trees are only built once.
+    """
+    strips = {'uniform': np.linspace(0., 1., 81)*2.*np.pi,
+              'nonuniform': (np.linspace(0., 1., 81)**2)*2.*np.pi}
+    neighbors = {}
+    for name, X in strips.items():
+        data = np.array([X]).transpose()
+        for k in [20, 40]:
+            neighbors[name, k] = NearestNeighbors(n_neighbors=k).fit(data)
+    return neighbors
+
+
+@pytest.fixture(scope='module')
+def weighting_1d_data():
+    """
+    Data for the reweighting tests: samples on [-6.25, 6.25] that are denser
+    near the origin, out-of-sample points on [-5, 5], and the Hermite
+    polynomials evaluated on each.
+    """
+    X = np.linspace(0, 2.5, 101)**2
+    X = np.hstack([-1 * np.copy(X[1:][::-1]), X])
+    Y = np.linspace(-5., 5., 101)
+    return WeightingData(data_x=np.array([X]).transpose(), data_y=np.array([Y]).transpose(),
+                         real_evecs_x=_hermite_polynomials(X), real_evecs_y=_hermite_polynomials(Y))
 
 
 class TestDiffusionMap(object):
     @pytest.mark.parametrize('epsilon', [0.002, 'bgh'])
-    def test_1Dstrip_evals(self, epsilon):
+    def test_1Dstrip_evals(self, strip_1d_neighbors, epsilon):
         """
         Test that we compute the correct eigenvalues on a 1d strip of length 2*pi.
         Diffusion map parameters in this test are hand-selected to give good results.
@@ -20,7 +74,7 @@ class TestDiffusionMap(object):
         THRESH = 0.05
         # Setup diffusion map
         mydmap = dm.DiffusionMap.from_sklearn(n_evecs=4, epsilon=epsilon, alpha=1.0, k=20)
-        mydmap.fit(data)
+        mydmap.fit(data, precomputed_neighbors=strip_1d_neighbors['uniform', 20])
 
         # Check that relative error values are beneath tolerance.
         errors_eval = abs((mydmap.evals - real_evals)/real_evals)
@@ -29,7 +83,7 @@ class TestDiffusionMap(object):
         assert(total_error < THRESH)
 
     @pytest.mark.parametrize('epsilon', [0.002, 'bgh'])
-    def test_1Dstrip_evecs(self, epsilon):
+    def test_1Dstrip_evecs(self, strip_1d_neighbors, epsilon):
         """
         Test that we compute the correct eigenvectors (cosines) on a 1d strip of length 2*pi.
         Diffusion map parameters in this test are hand-selected to give good results.
@@ -43,17 +97,15 @@ class TestDiffusionMap(object):
         THRESH = 0.003
         # Setup diffusion map
         mydmap = dm.DiffusionMap.from_sklearn(n_evecs=4, epsilon=epsilon, alpha=1.0, k=40)
-        mydmap.fit_transform(data)
-        errors_evec = []
-        for k in np.arange(4):
-            errors_evec.append(abs(np.corrcoef(np.cos(0.5*(k+1)*X), mydmap.evecs[:, k])[0, 1]))
+        mydmap.fit_transform(data, precomputed_neighbors=strip_1d_neighbors['uniform', 40])
+        errors_evec = _abs_correlations([np.cos(0.5*(k+1)*X) for k in range(4)], mydmap.evecs)
 
         # Check that relative error values are beneath tolerance.
         total_error = 1 - np.min(errors_evec)
         assert(total_error < THRESH)
 
     @pytest.mark.parametrize('epsilon', [0.005, 'bgh'])
-    def test_1Dstrip_nonunif_evals(self, epsilon):
+    def test_1Dstrip_nonunif_evals(self, strip_1d_neighbors, epsilon):
         """
         Test that we compute the correct eigenvalues on a 1d strip of length 2*pi with nonuniform sampling.
         Diffusion map parameters in this test are hand-selected to give good results.
@@ -68,7 +120,7 @@ class TestDiffusionMap(object):
         THRESH = 0.1
         # Setup diffusion map
         mydmap = dm.DiffusionMap.from_sklearn(n_evecs=4, epsilon=epsilon, alpha=1.0, k=40)
-        mydmap.fit_transform(data)
+        mydmap.fit_transform(data, precomputed_neighbors=strip_1d_neighbors['nonuniform', 40])
 
         # Check that relative error values are beneath tolerance.
         errors_eval = abs((mydmap.evals- real_evals)/real_evals)
@@ -76,7 +128,7 @@ class TestDiffusionMap(object):
         assert(total_error < THRESH)
 
     @pytest.mark.parametrize('epsilon', [0.005, 'bgh'])
-    def test_1Dstrip_nonunif_evecs(self, epsilon):
+    def test_1Dstrip_nonunif_evecs(self, strip_1d_neighbors, epsilon):
         """
         Test that we compute the correct eigenvectors (cosines) on a 1d strip of length 2*pi with nonuniform sampling.
         Diffusion map parameters in this test are hand-selected to give good results.
@@ -90,10 +142,8 @@ class TestDiffusionMap(object):
         THRESH = 0.01
         # Setup diffusion map
         mydmap = dm.DiffusionMap.from_sklearn(n_evecs=4, epsilon=epsilon, alpha=1.0, k=40)
-        mydmap.fit_transform(data)
-        errors_evec = []
-        for k in np.arange(4):
-            errors_evec.append(abs(np.corrcoef(np.cos(0.5*(k+1)*X), mydmap.evecs[:, k])[0, 1]))
+        mydmap.fit_transform(data, precomputed_neighbors=strip_1d_neighbors['nonuniform', 40])
+        errors_evec = _abs_correlations([np.cos(0.5*(k+1)*X) for k in range(4)], mydmap.evecs)
 
         # Check that relative error values are beneath tolerance.
         total_error = 1 - np.min(errors_evec)
@@ -136,11 +186,8 @@ class TestDiffusionMap(object):
         eps = 0.0025
         mydmap = dm.DiffusionMap.from_sklearn(n_evecs=4, alpha=1.0, k=100, epsilon=eps)
         mydmap.fit(data)
-        errors_evec = []
-        errors_evec.append(abs(np.corrcoef(np.cos(0.5*1*X), mydmap.evecs[:, 0])[0, 1]))
-        errors_evec.append(abs(np.corrcoef(np.cos(Y), mydmap.evecs[:, 1])[0, 1]))
-        errors_evec.append(abs(np.corrcoef(np.cos(0.5*2*X), mydmap.evecs[:, 2])[0, 1]))
-        errors_evec.append(abs(np.corrcoef(np.cos(0.5*1*X)*np.cos(Y), mydmap.evecs[:, 3])[0, 1]))
+        real_evecs = [np.cos(0.5*1*X), np.cos(Y), np.cos(0.5*2*X), np.cos(0.5*1*X)*np.cos(Y)]
+        errors_evec = _abs_correlations(real_evecs, mydmap.evecs)
 
         # Check that relative error values are beneath tolerance.
         total_error = 1 - np.min(errors_evec)
@@ -228,6 +275,40 @@ class TestDiffusionMap(object):
 
         assert(err < THRESH)
 
+    def test_lazy_generator(self, harmonic_1d_data):
+        """
+        Test that fitting does not build L, and that it is rebuilt after refitting.
+        """
+        data = harmonic_1d_data
+        mydmap = dm.DiffusionMap.from_sklearn(n_evecs=3, epsilon='bgh', k=64)
+        mydmap.fit(data)
+        assert(mydmap._L is None)
+        L = mydmap.L
+        assert(np.allclose(L.sum(axis=1), 0.))
+        assert(mydmap.L is L)
+        mydmap.fit(data[::2])
+        assert(mydmap.L.shape == (len(data[::2]), len(data[::2])))
+
+    @pytest.mark.parametrize('dmap_params', [{}, {'weight_fxn': lambda x: np.exp(-.25*np.dot(x, x))},
+                                             {'bandwidth_type': -0.5, 'bandwidth_normalize': True, 'alpha': 0.}])
+    @pytest.mark.parametrize('solver', ['dense', 'sparse', 'shift_invert'])
+    def test_symmetric_eigensolver(self, harmonic_1d_data, dmap_params, solver, monkeypatch):
+        """
+        Test that the eigenpairs computed from the symmetrized generator agree with those of L,
+        using the dense, sparse and shift-invert eigensolvers.
+        """
+        if solver != 'dense':
+            monkeypatch.setattr(dm, '_DENSE_EIGSOLVE_MAX_N', 0)
+        data = harmonic_1d_data
+        mydmap = dm.DiffusionMap.from_sklearn(n_evecs=3, epsilon='bgh', k=64, shift_invert=(solver == 'shift_invert'),
+                                              **dmap_params)
+        mydmap.fit(data)
+        ref_dmap, ref_evecs, ref_evals = mydmap._make_diffusion_coords(mydmap.L)
+        assert(np.max(np.abs((mydmap.evals - ref_evals)/ref_evals)) < 1e-8)
+        for k in range(3):
+            assert(1 - abs(np.dot(mydmap.evecs[:, k], ref_evecs[:, k])) < 1e-8)
+
+
 class TestNystroem(object):
     @pytest.mark.parametrize('method', ['nystroem', 'power'])
     def test_2Dstrip_nystroem(self, uniform_2d_data, method):
@@ -256,12 +337,24 @@ class TestNystroem(object):
         error = min([np.linalg.norm(V_true+V_test), np.linalg.norm(V_true-V_test)])
         assert(error < THRESH)
 
+    def test_nystroem_blocks(self, uniform_2d_data):
+        """
+        Test that the blocked nystroem extension does not depend on the block size.
+        """
+        data, X, Y = uniform_2d_data
+        mydmap = dm.DiffusionMap.from_sklearn(n_evecs=2, alpha=1.0, k=50, epsilon=0.01)
+        mydmap.fit(data)
+        X_test = np.random.RandomState(0).uniform(0, np.pi, size=(300, 2))
+        ref_ext = dm.nystroem_oos(mydmap, X_test, block_size=300)
+        dmap_ext = dm.nystroem_oos(mydmap, X_test, block_size=7)
+        assert(np.max(np.abs(ref_ext - dmap_ext)) < 1e-12)
+
 
 class TestWeighting(object):
     @pytest.mark.parametrize('epsilon', [0.002, 'bgh'])
     @pytest.mark.parametrize('oos', ['power', 'nystroem', False])
     @pytest.mark.parametrize('dmap_method', ['base', 'TMDmap'])
-    def test_1Dstrip_evecs(self, epsilon, oos, dmap_method):
+    def test_1Dstrip_evecs(self, weighting_1d_data, epsilon, oos, dmap_method):
         """
         Test measure reweighting.  We reweight the uniform distribution to
         approximate a Gaussian distribution.  For numerical reasons, we truncate
@@ -271,21 +364,17 @@ class TestWeighting(object):
         probabalists Hermite polynomials.
         """
         # Setup data and accuracy threshold
-        # X = np.linspace(-5., 5., 201)
-        X = np.linspace(0, 2.5, 101)**2
-        X = np.hstack([-1 * np.copy(X[1:][::-1]), X])
+        data_x = weighting_1d_data.data_x
         if not oos:
-            Y = X
+            data_y = data_x
+            real_evecs = weighting_1d_data.real_evecs_x
             oos = 'nystroem'
         else:
-            Y = np.linspace(-5., 5., 101)
-        data_x = np.array([X]).transpose()
-        data_y = np.array([Y]).transpose()
+            data_y = weighting_1d_data.data_y
+            real_evecs = weighting_1d_data.real_evecs_y
         EVEC_THRESH = 0.005
         EVAL_THRESH = 0.003
         # Setup true values to test against.
-        real_evecs = [Y, Y**2-1, Y**3-3*Y,
-                      Y**4-6*Y**2+3]  # Hermite polynomials
         real_evals = -1 * np.arange(1, 5)
         # Setup diffusion map
         if dmap_method == 'TMDmap':
@@ -298,9 +387,7 @@ class TestWeighting(object):
         # Fit data and build dmap
         mydmap.fit(data_x)
         evecs = mydmap.transform(data_y)
-        errors_evec = []
-        for k in range(4):
-            errors_evec.append(abs(np.corrcoef(real_evecs[k], evecs[:, k])[0, 1]))
+        errors_evec = _abs_correlations(real_evecs, evecs)
 
         # Check that relative evec error values are beneath tolerance.
         total_evec_error = 1 - np.min(errors_evec)
@@ -329,11 +416,9 @@ class TestBandwidths(object):
         mydmap = dm.DiffusionMap.from_sklearn(n_evecs=3, epsilon='bgh', alpha=alpha,
                                  k=50, bandwidth_type=bandwidth_type, bandwidth_normalize=True)
         mydmap.fit_transform(data)
-        errors_evec = []
-        for k in np.arange(3):
-            errors_evec.append(abs(np.corrcoef(ref_evecs[k], mydmap.evecs[:, k])[0, 1]))
+        errors_evec = _abs_correlations(ref_evecs, mydmap.evecs)
         # Check that relative error values are beneath tolerance.
-        total_error = 1 - np.array(errors_evec)
+        total_error = 1 - errors_evec
         assert((total_error < THRESHS).all())
 
     @pytest.mark.parametrize('alpha_beta', [(0., -1./3), (-1./4, -1./2)])
@@ -355,9 +440,7 @@ class TestBandwidths(object):
                                  oos='power')
         mydmap.fit(data)
         oos_evecs = mydmap.transform(oos_data)
-        errors_evec = []
-        for k in np.arange(3):
-            errors_evec.append(abs(np.corrcoef(ref_evecs[k], oos_evecs[:, k])[0, 1]))
+        errors_evec = _abs_correlations(ref_evecs, oos_evecs)
         # Check that relative error values are beneath tolerance.
-        total_error = 1 - np.array(errors_evec)
+        total_error = 1 - errors_evec
         assert((total_error < THRESHS).all())
@@ -134,6 +134,56 @@ class TestKernel(object):
             assert(mykernel.epsilon_fitted == 0.50)
         assert(mykernel.d == 1.0)
 
+    @pytest.mark.parametrize('x_values', x_values_set)
+    def test_precomputed_neighbors(self, x_values):
+        """
+        Test that a precomputed nearest neighbor object gives the same kernel.
+        """
+        ref_kernel = kernel.Kernel(epsilon=1., k=5).fit(x_values)
+        neighbors = NearestNeighbors(n_neighbors=5).fit(x_values)
+        mykernel = kernel.Kernel(epsilon=1., k=5).fit(x_values, neighbors=neighbors)
+        assert(mykernel.neigh is neighbors)
+        assert(np.linalg.norm((ref_kernel.compute() - mykernel.compute()).toarray()) < 1E-10)
+        with pytest.raises(ValueError):
+            kernel.Kernel(epsilon=1., k=6).fit(x_values, neighbors=neighbors)
+
+    @pytest.mark.parametrize('neighbor_metric, kernel_metric, matches', [
+        ({'p': 1}, {'metric': 'cityblock'}, True),
+        ({'metric': 'minkowski', 'p': 3}, {'metric': 'minkowski', 'metric_params': {'p': 3}}, True),
+        ({'metric': 'manhattan'}, {}, False),
+        ({'metric': 'minkowski', 'p': 3}, {'metric': 'minkowski', 'metric_params': {'p': 4}}, False),
+        ({'metric': 'seuclidean', 'metric_params': {'V': np.ones(2)}}, {'metric': 'seuclidean', 'metric_params': {'V': 2 * np.ones(2)}}, False)])
+    def test_precomputed_neighbors_metric(self, neighbor_metric, kernel_metric, matches):
+        """
+        Test that precomputed nearest neighbors must use the same metric as the kernel.
+        """
+        X = x_values_set[0]
+        neighbors = NearestNeighbors(n_neighbors=5, **neighbor_metric).fit(X)
+        mykernel = kernel.Kernel(epsilon=1., k=5, **kernel_metric)
+        if matches:
+            mykernel.fit(X, neighbors=neighbors)
+        else:
+            with pytest.raises(ValueError):
+                mykernel.fit(X, neighbors=neighbors)
+
+    @pytest.mark.slow
+    def test_pynndescent_backend(self):
+        """
+        Test that the approximate neighbor backend agrees with the exact one on a small dataset.
+        The kde bandwidth and out-of-sample points exercise both the fitted neighbor graph and queries.
+        """
+        pytest.importorskip('pynndescent')
+        y_values = np.linspace(-1, 1, 14).reshape(-1, 2)
+        bandwidth_type = -0.5
+        X = np.random.RandomState(0).uniform(-1, 1, size=(40, 2))
+        ref_kernel = kernel.Kernel(epsilon=0.1, k=10, bandwidth_type=bandwidth_type)
+        ref_kernel.fit(X)
+        nnd_kernel = kernel.Kernel(epsilon=0.1, k=10, bandwidth_type=bandwidth_type,
+                                   neighbor_backend='pynndescent', neighbor_params={'random_state': 0})
+        nnd_kernel.fit(X)
+        error = ref_kernel.compute(y_values) - nnd_kernel.compute(y_values)
+        assert(np.max(np.abs(error.toarray())) < 1E-6)
+
 
 class TestKNN(object):
     def test_harmonic_kde(self, harmonic_1d_data):
@@ -163,3 +213,63 @@ class TestBGHEpsilonSelection(object):
         eps, d = kernel.choose_optimal_epsilon_BGH(sq_dist, epsilons)
         assert(eps == 0.25)
         assert(d == 1.0)
+
+
+class _StubNNDescentIndex(object):
+    """
+    Stands in for a fitted pynndescent index, returning fixed neighbors.
+    """
+
+    def __init__(self, indices, distances):
+        self.neighbor_graph = (indices, distances)
+
+    def query(self, X, k=10):
+        n_query = np.shape(X)[0]
+        indices = np.tile(np.arange(k), (n_query, 1))
+        distances = np.tile(np.arange(1., k + 1.), (n_query, 1))
+        return indices, distances
+
+
+class TestNNDescentNeighbors(object):
+    @pytest.fixture
+    def stub_neighbors(self):
+        # Point 2 is missing from its own neighbor list, and point 3 is not listed first.
+        indices = np.array([[0, 1, 2], [1, 0, 3], [3, 1, 0], [2, 3, 1]])
+        distances = np.array([[0., 1., 2.], [0., 1., 3.], [1., 2., 4.], [1., 0., 3.]])
+        X = np.arange(8.).reshape(4, 2)
+        neigh = kernel.NNDescentNeighbors(n_neighbors=2)
+        neigh._fit_X = X
+        neigh.n_samples_fit_ = 4
+        neigh.index = _StubNNDescentIndex(indices, distances)
+        return neigh
+
+    def test_self_removal(self, stub_neighbors):
+        ref_graph = np.array([[0., 1., 2., 0.],
+                              [1., 0., 0., 3.],
+                              [0., 2., 0., 1.],
+                              [0., 3., 1., 0.]])
+        graph = stub_neighbors.kneighbors_graph(mode='distance')
+        assert(sps.isspmatrix_csr(graph))
+        assert(np.all(graph.toarray() == ref_graph))
+        connectivity = stub_neighbors.kneighbors_graph()
+        assert(np.all(connectivity.toarray() == (ref_graph > 0)))
+
+    def test_fit_data_query(self, stub_neighbors):
+        ref_graph = np.array([[0., 1., 0., 0.],
+                              [1., 0., 0., 0.],
+                              [0., 2., 0., 1.],
+                              [0., 0., 1., 0.]])
+        graph = stub_neighbors.kneighbors_graph(stub_neighbors._fit_X, mode='distance')
+        assert(graph.shape == (4, 4))
+        assert(graph.nnz == 8)
+        assert(np.all(graph.toarray() == ref_graph))
+
+    def test_new_data_query(self, stub_neighbors):
+        Y = np.ones((3, 2))
+        graph = stub_neighbors.kneighbors_graph(Y, n_neighbors=3, mode='distance')
+        assert(graph.shape == (3, 4))
+        assert(np.all(graph.toarray() == np.tile([1., 2., 3., 0.], (3, 1))))
+
+    def test_unknown_mode(self, stub_neighbors):
+        with pytest.raises(ValueError):
+            stub_neighbors.kneighbors_graph(mode='similarity')
@@ -1,8 +1,10 @@
+import os
 import numpy as np
 import pytest
 
 from pydiffmap import utils
 from scipy.sparse import csr_matrix
+from scipy.sparse import random as sparse_random
 from sklearn.neighbors import NearestNeighbors
 
 x_1d = np.arange(10)
@@ -22,25 +24,119 @@ class TestLookupFunction(object):
         shuffle_y = np.array([lf(xi) for xi in x[shuffle_indices]])
         assert((shuffle_y == vals[shuffle_indices]).all())
 
+    @pytest.mark.parametrize('x', [x_1d, x_2d])
+    @pytest.mark.parametrize('vals', [y_1d, y_2d])
+    def test_lookup_fxn_batch(self, x, vals):
+        shuffle_indices = np.random.permutation(len(x))
+        lf = utils.lookup_fxn(x, vals)
+        shuffle_y = lf.batch(x[shuffle_indices])
+        assert((shuffle_y == vals[shuffle_indices]).all())
+
+    def test_lookup_fxn_list(self):
+        x = [str(xi) for xi in x_1d]
+        lf = utils.lookup_fxn(x, y_1d)
+        assert(lf('3') == y_1d[3])
+        assert((lf.batch(x[::-1]) == y_1d[::-1]).all())
+
+    @pytest.mark.parametrize('x', [np.array([3, 1, 3, 2, 1]), [3, 1, 3, 2, 1]])
+    def test_lookup_fxn_duplicates(self, x):
+        # Repeated inputs return the last value given, as for a dictionary.
+        vals = np.arange(5) + 0.5
+        lf = utils.lookup_fxn(x, vals)
+        assert(lf(3) == 2.5)
+        assert(lf(1) == 4.5)
+        assert((lf.batch([1, 2, 3]) == [4.5, 3.5, 2.5]).all())
+
+    @pytest.mark.parametrize('vals', [[np.zeros(2), np.zeros(3), 1.0], ['a', 'b', None]])
+    def test_lookup_fxn_nonnumeric_vals(self, vals):
+        # Ragged or non-numeric outputs are returned unchanged, as for a dictionary.
+        lf = utils.lookup_fxn(np.arange(3), vals)
+        for i in range(3):
+            assert(lf(i) is vals[i])
+
+    def test_lookup_fxn_missing(self):
+        lf = utils.lookup_fxn(x_1d, y_1d)
+        with pytest.raises(KeyError):
+            lf(0.5)
+        with pytest.raises(KeyError):
+            lf(-1)
+        with pytest.raises(KeyError):
+            lf(20)
+
+
+def _pairwise_dist(Y, X):
+    return np.linalg.norm(Y - X)
+
+
+def _blockwise_dist(Y, X):
+    return np.linalg.norm(Y - X, axis=-1)
+
 
 class TestSparseFromFxn(object):
     @pytest.mark.parametrize('Y', [y_2d, None])
-    def test_sparse_from_fxn(self, Y):
-        nneighbors = NearestNeighbors(10)
+    @pytest.mark.parametrize('dist_fxn', [_pairwise_dist, _blockwise_dist])
+    def test_sparse_from_fxn(self, Y, dist_fxn):
+        nneighbors = NearestNeighbors(n_neighbors=10)
+        nneighbors.fit(x_2d)
+        Y2 = Y
+        if Y2 is None:
+            Y2 = x_2d
+        K = nneighbors.kneighbors_graph(Y2, mode='connectivity')
+        ref_mat = nneighbors.kneighbors_graph(Y2, mode='distance')
+        dist_mat = utils.sparse_from_fxn(x_2d, K, dist_fxn, Y)
+        assert(np.linalg.norm((dist_mat - ref_mat).data) < 1e-10)
+
+    @pytest.mark.parametrize('Y', [y_2d, None])
+    def test_sparse_from_fxn_numba(self, Y):
+        numba = pytest.importorskip('numba')
+        nneighbors = NearestNeighbors(n_neighbors=10)
         nneighbors.fit(x_2d)
         Y2 = Y
         if Y2 is None:
             Y2 = x_2d
         K = nneighbors.kneighbors_graph(Y2, mode='connectivity')
         ref_mat = nneighbors.kneighbors_graph(Y2, mode='distance')
-        dist_fxn = lambda Y, X: np.linalg.norm(Y - X)
+        dist_fxn = numba.njit(lambda y, x: np.sqrt(np.sum((y - x)**2)))
         dist_mat = utils.sparse_from_fxn(x_2d, K, dist_fxn, Y)
         assert(np.linalg.norm((dist_mat - ref_mat).data) < 1e-10)
 
+    def test_sparse_from_fxn_blocks(self, monkeypatch):
+        monkeypatch.setattr(utils, '_PAIR_BLOCK_BYTES', 7 * 32)
+        nneighbors = NearestNeighbors(n_neighbors=10)
+        nneighbors.fit(x_2d)
+        K = nneighbors.kneighbors_graph(y_2d, mode='connectivity')
+        ref_mat = nneighbors.kneighbors_graph(y_2d, mode='distance')
+        dist_mat = utils.sparse_from_fxn(x_2d, K, _blockwise_dist, y_2d)
+        assert(np.linalg.norm((dist_mat - ref_mat).data) < 1e-10)
+
+    @pytest.mark.parametrize('Y', [y_2d, None])
+    def test_sparse_from_fxn_of_distance(self, Y):
+        nneighbors = NearestNeighbors(n_neighbors=10)
+        nneighbors.fit(x_2d)
+        Y2 = Y
+        if Y2 is None:
+            Y2 = x_2d
+        D = nneighbors.kneighbors_graph(Y2, mode='distance')
+        ref_mat = utils.sparse_from_fxn(x_2d, D, lambda Y, X: np.exp(-np.linalg.norm(Y - X)**2), Y)
+        kernel_mat = utils.sparse_from_fxn(x_2d, D, None, Y, function_of_distance=lambda d: np.exp(-d**2))
+        assert(np.linalg.norm((kernel_mat - ref_mat).toarray()) < 1e-10)
+        assert(np.all(D.data == nneighbors.kneighbors_graph(Y2, mode='distance').data))
+
 
 class TestSymmetrization():
     test_mat = csr_matrix([[0, 2.], [0, 3.]])
 
+    @pytest.fixture(autouse=True, params=['compiled', 'python'])
+    def backend(self, request, monkeypatch):
+        if request.param == 'compiled':
+            if utils._symmetrize_csr is None:
+                if os.environ.get('PYDIFFMAP_REQUIRE_COMPILED'):
+                    pytest.fail('Compiled symmetrization routine is not built.')
+                pytest.skip('Compiled symmetrization routine is not built.')
+        else:
+            monkeypatch.setattr(utils, '_symmetrize_csr', None)
+        return request.param
+
     def test_and_symmetrization(self):
         ref_mat = np.array([[0, 0], [0, 3.]])
         symmetrized = utils._symmetrize_matrix(self.test_mat, mode='and')
@@ -58,3 +154,16 @@ class TestSymmetrization():
         symmetrized = utils._symmetrize_matrix(self.test_mat, mode='average')
         symmetrized = symmetrized.toarray()
         assert (np.linalg.norm(ref_mat - symmetrized) == 0.)
+
+    @pytest.mark.parametrize('mode', ['and', 'or', 'average'])
+    def test_random_symmetrization(self, mode):
+        K = sparse_random(50, 50, density=0.1, format='csr', random_state=0)
+        dense_K = K.toarray()
+        ref_fxns = {'and': np.minimum, 'or': np.maximum, 'average': lambda A, B: 0.5*(A + B)}
+        ref_mat = ref_fxns[mode](dense_K, dense_K.T)
+        symmetrized = utils._symmetrize_matrix(K, mode=mode).toarray()
+        assert (np.max(np.abs(ref_mat - symmetrized)) < 1e-15)
+
+    def test_unknown_mode(self):
+        with pytest.raises(ValueError):
+            utils._symmetrize_matrix(self.test_mat, mode='xor')
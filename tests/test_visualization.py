@@ -51,6 +51,36 @@ if sys.version_info[0] >= 3:
             fig = viz.embedding_plot(mydmap, scatter_kwargs=scatter_kwargs, show=False)
             assert(fig)
 
+        def test_rasterized(self, dummy_dmap):
+            fig = viz.embedding_plot(dummy_dmap, show=False)
+            SC = fig.axes[0].collections[0]
+            assert(SC.get_rasterized())
+
+        @pytest.mark.parametrize('scatter_kwargs, expect_scatter', [
+            (None, False),
+            ({'cmap': 'Blues'}, False),
+            ({'c': 'r'}, True),
+            ({'s': 4.}, True),
+            ({'alpha': 0.5}, True),
+            ({'marker': 'x'}, True),
+            ({'c': 'pointwise'}, True)])
+        def test_hexbin(self, dummy_dmap, scatter_kwargs, expect_scatter):
+            mydmap = dummy_dmap
+            if scatter_kwargs == {'c': 'pointwise'}:
+                scatter_kwargs = {'c': mydmap.dmap[:, 0]}
+            fig = viz.embedding_plot(mydmap, scatter_kwargs=scatter_kwargs, show=False, hexbin_threshold=100)
+            SC = fig.axes[0].collections[0]
+            is_scatter = (len(SC.get_offsets()) == mydmap.dmap.shape[0])
+            assert(is_scatter == expect_scatter)
+
+        def test_hexbin_kwargs(self, dummy_dmap):
+            scatter_kwargs = {'rasterized': False, 'linewidths': 2.}
+            fig = viz.embedding_plot(dummy_dmap, scatter_kwargs=scatter_kwargs, show=False, hexbin_threshold=100)
+            SC = fig.axes[0].collections[0]
+            assert(len(SC.get_offsets()) != dummy_dmap.dmap.shape[0])
+            assert(not SC.get_rasterized())
+            assert(np.all(SC.get_linewidths() == 2.))
+
     class TestDataPlot():
         def test_no_kwargs(self, dummy_dmap):
             mydmap = dummy_dmap